@@ -1,8 +1,152 @@
+import json
+import os
+
 import numpy as np
 
+
+def encode_array(obj):
+    """json.dumps hook for RNG states holding arrays (e.g. MT19937 keys)"""
+    if isinstance(obj, np.ndarray):
+        return {"__ndarray__": obj.tolist(), "dtype": str(obj.dtype)}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def decode_array(obj):
+    """json.loads hook undoing encode_array()"""
+    if "__ndarray__" in obj:
+        return np.array(obj["__ndarray__"], dtype=obj["dtype"])
+    return obj
+
+
+class DistanceField2D:
+    # Channels of the lookup table: obstacle distance and gradient, goal distance gradient
+    CHANNELS = 5
+
+    # Settings and grids stored in checkpoints
+    STATE = ("size", "resolution", "margin", "obstacles", "goals")
+
+    def __init__(self, size=100, resolution=1.0, margin=5.0):
+        """
+        Precomputed signed-distance field for obstacles and goals in a 2D world
+
+        Shapes are rasterized onto a grid once when added; each simulation step
+        then samples the grid for all boids with bilinear interpolation, so the
+        per-step cost does not grow with the number of obstacles.
+
+        Args:
+            size: World size (size x size), should match the boids world
+            resolution: Grid spacing in world units
+            margin: Distance from an obstacle surface to start steering away
+        """
+        self.size = size
+        self.resolution = resolution
+        self.margin = margin
+        self.cells = int(np.ceil(size / resolution))
+
+        coords = np.arange(self.cells + 1) * resolution
+        self.points = np.stack(np.meshgrid(coords, coords, indexing="ij"), axis=-1)
+
+        # No distance on the grid exceeds its diagonal, so use it for "nothing here"
+        far = self.cells * resolution * np.sqrt(2)
+        self.obstacles = np.full(self.points.shape[:-1], far)
+        self.goals = np.full(self.points.shape[:-1], far)
+        self.table = np.zeros(self.points.shape[:-1] + (self.CHANNELS,))
+        self.build_table()
+
+    def build_table(self):
+        """Recompute the gradients and pack everything sampled per step into one grid"""
+        self.table[..., 0] = self.obstacles
+        self.table[..., 1:3] = np.stack(np.gradient(self.obstacles, self.resolution), axis=-1)
+        self.table[..., 3:5] = np.stack(np.gradient(self.goals, self.resolution), axis=-1)
+
+    def add_obstacle_distance(self, distance):
+        """Merge a signed distance grid (negative inside) for a new obstacle"""
+        self.obstacles = np.minimum(self.obstacles, distance)
+        self.build_table()
+
+    def add_goal_distance(self, distance):
+        """Merge a distance grid for a new goal"""
+        self.goals = np.minimum(self.goals, distance)
+        self.build_table()
+
+    def add_circle(self, center, radius):
+        """Add a circular obstacle"""
+        distance = np.linalg.norm(self.points - np.asarray(center, dtype=float), axis=-1) - radius
+        self.add_obstacle_distance(distance)
+
+    def add_polygon(self, vertices):
+        """Add a polygonal obstacle given its vertices in order"""
+        vertices = np.asarray(vertices, dtype=float)
+        points = self.points.reshape(-1, 2)
+        distance = np.full(len(points), np.inf)
+        inside = np.zeros(len(points), dtype=bool)
+
+        for a, b in zip(vertices, np.roll(vertices, -1, axis=0)):
+            # Distance to the closest point on this edge
+            edge = b - a
+            t = np.clip((points - a) @ edge / max(edge @ edge, 1e-12), 0, 1)
+            distance = np.minimum(distance, np.linalg.norm(points - a - t[:, np.newaxis] * edge, axis=1))
+
+            # Even-odd rule: count crossings of a ray cast in the +x direction
+            crosses = (a[1] > points[:, 1]) != (b[1] > points[:, 1])
+            x_cross = a[0] + (points[:, 1] - a[1]) * edge[0] / (edge[1] if edge[1] != 0 else 1)
+            inside ^= crosses & (points[:, 0] < x_cross)
+
+        distance = np.where(inside, -distance, distance)
+        self.add_obstacle_distance(distance.reshape(self.points.shape[:-1]))
+
+    def add_goal(self, point):
+        """Add a goal point that attracts boids"""
+        self.add_goal_distance(np.linalg.norm(self.points - np.asarray(point, dtype=float), axis=-1))
+
+    def sample(self, positions):
+        """
+        Bilinearly interpolate the field at positions (shape (n, 2))
+
+        Returns:
+            Obstacle distances (n,), obstacle gradients (n, 2) and goal gradients (n, 2)
+        """
+        u = np.clip(positions / self.resolution, 0, self.cells)
+        i0 = np.minimum(np.floor(u).astype(int), self.cells - 1)
+        t = u - i0
+
+        values = np.zeros((len(positions), self.CHANNELS))
+        for dx in (0, 1):
+            for dy in (0, 1):
+                weight = (t[:, 0] if dx else 1 - t[:, 0]) * (t[:, 1] if dy else 1 - t[:, 1])
+                values += weight[:, np.newaxis] * self.table[i0[:, 0] + dx, i0[:, 1] + dy]
+
+        return values[:, 0], values[:, 1:3], values[:, 3:5]
+
+    def state(self):
+        """Arrays and settings needed to rebuild the field without re-rasterizing shapes"""
+        return {name: getattr(self, name) for name in self.STATE}
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild a field from state()"""
+        size, resolution, margin = (np.asarray(state[name]).item() for name in ("size", "resolution", "margin"))
+        field = cls(size=size, resolution=resolution, margin=margin)
+        field.add_obstacle_distance(state["obstacles"])
+        field.add_goal_distance(state["goals"])
+        return field
+
+
 class Boids2D:
-    def __init__(self, 
-                 n=50, 
+    # Per-boid parameters stored in checkpoints alongside the arrays
+    PARAMS = ("max_speed", "max_force",
+              "separation_radius", "alignment_radius", "cohesion_radius",
+              "separation_weight", "alignment_weight", "cohesion_weight",
+              "obstacle_weight", "attractor_weight")
+
+    # Species-pair interaction matrices
+    MATRICES = ("separation_matrix", "alignment_matrix", "cohesion_matrix")
+
+    # Boid pairs handled per vectorized chunk, keeping update() memory flat as n grows
+    CHUNK_PAIRS = 2**18
+
+    def __init__(self,
+                 n=50,
                  size=100,
                  max_speed=2.0,
                  max_force=0.1,
@@ -11,144 +155,291 @@ class Boids2D:
                  cohesion_radius=10.0,
                  separation_weight=1.5,
                  alignment_weight=1.0,
-                 cohesion_weight=1.0):
+                 cohesion_weight=1.0,
+                 seed=None,
+                 species=None,
+                 separation_matrix=None,
+                 alignment_matrix=None,
+                 cohesion_matrix=None,
+                 field=None,
+                 obstacle_weight=2.0,
+                 attractor_weight=0.5):
         """
         Simple 2D boids with configurable parameters
-        
+
+        Every behaviour parameter may be a single value shared by the whole
+        flock or an array with one value per boid.
+
         Args:
             n: Number of boids
             size: World size (size x size)
             max_speed: Maximum speed of boids
             max_force: Maximum steering force
             separation_radius: Distance for separation behavior
-            alignment_radius: Distance for alignment behavior  
+            alignment_radius: Distance for alignment behavior
             cohesion_radius: Distance for cohesion behavior
             separation_weight: Weight for separation force
             alignment_weight: Weight for alignment force
             cohesion_weight: Weight for cohesion force
+            seed: Seed (or np.random.Generator) for reproducible runs
+            species: Integer species tag per boid (default: all species 0)
+            separation_matrix: matrix[a, b] >= 0 scales how strongly species a
+                avoids neighbours of species b (default: all ones)
+            alignment_matrix: Same, for matching neighbour velocities
+            cohesion_matrix: Same, for steering toward neighbours
+            field: Optional DistanceField2D with obstacles and goals
+            obstacle_weight: Weight for steering around obstacles
+            attractor_weight: Weight for steering toward goals
         """
         self.n = n
         self.size = size
-        self.max_speed = max_speed
-        self.max_force = max_force
-        self.separation_radius = separation_radius
-        self.alignment_radius = alignment_radius
-        self.cohesion_radius = cohesion_radius
-        self.separation_weight = separation_weight
-        self.alignment_weight = alignment_weight
-        self.cohesion_weight = cohesion_weight
-        
+        self.max_speed = self.per_boid(max_speed)
+        self.max_force = self.per_boid(max_force)
+        self.separation_radius = self.per_boid(separation_radius)
+        self.alignment_radius = self.per_boid(alignment_radius)
+        self.cohesion_radius = self.per_boid(cohesion_radius)
+        self.separation_weight = self.per_boid(separation_weight)
+        self.alignment_weight = self.per_boid(alignment_weight)
+        self.cohesion_weight = self.per_boid(cohesion_weight)
+        self.obstacle_weight = self.per_boid(obstacle_weight)
+        self.attractor_weight = self.per_boid(attractor_weight)
+        if field is not None and field.size != size:
+            raise ValueError(f"field size {field.size} does not match world size {size}")
+        self.field = field
+
+        if species is None:
+            species = np.zeros(n, dtype=int)
+        self.species = np.asarray(species, dtype=int)
+        if self.species.shape != (n,):
+            raise ValueError(f"species must have shape ({n},), got {self.species.shape}")
+        if n > 0 and self.species.min() < 0:
+            raise ValueError("species tags must be non-negative")
+        n_species = int(self.species.max()) + 1 if n > 0 else 1
+        self.separation_matrix = self.species_matrix(separation_matrix, n_species)
+        self.alignment_matrix = self.species_matrix(alignment_matrix, n_species)
+        self.cohesion_matrix = self.species_matrix(cohesion_matrix, n_species)
+
+        self.rng = np.random.default_rng(seed)
+        self.steps = 0
+
         # Random positions and velocities
-        self.pos = np.random.random((n, 2)) * size
-        self.vel = (np.random.random((n, 2)) - 0.5) * max_speed
-        
+        self.pos = self.rng.random((n, 2)) * size
+        self.vel = (self.rng.random((n, 2)) - 0.5) * self.max_speed[:, np.newaxis]
+
         # Normalize initial velocities to max_speed
         speeds = np.linalg.norm(self.vel, axis=1)
         speeds = np.where(speeds == 0, 1, speeds)
-        self.vel = self.vel / speeds[:, np.newaxis] * max_speed
-    
-    def limit_force(self, force):
-        """Limit force magnitude to max_force"""
-        magnitude = np.linalg.norm(force)
-        if magnitude > self.max_force:
-            return force / magnitude * self.max_force
-        return force
-    
-    def boundary_force(self, position, velocity):
+        self.vel = self.vel / speeds[:, np.newaxis] * self.max_speed[:, np.newaxis]
+
+        if self.field is not None:
+            self.resolve_obstacles()
+
+    def per_boid(self, value):
+        """Broadcast a scalar or per-boid parameter to a float array of shape (n,)"""
+        value = np.asarray(value, dtype=float)
+        if value.ndim == 0:
+            return np.full(self.n, float(value))
+        if value.shape != (self.n,):
+            raise ValueError(f"per-boid parameter must have shape ({self.n},), got {value.shape}")
+        return value.copy()
+
+    def species_matrix(self, matrix, n_species):
+        """Validate a species-pair matrix, defaulting to full interaction between all species"""
+        if matrix is None:
+            return np.ones((n_species, n_species))
+        matrix = np.asarray(matrix, dtype=float)
+        if matrix.ndim != 2 or matrix.shape[0] != matrix.shape[1] or matrix.shape[0] < n_species:
+            raise ValueError(f"species matrix must be square and cover {n_species} species, "
+                             f"got shape {matrix.shape}")
+        # Weights feed weighted means, which break down when mixed signs cancel out
+        if np.any(matrix < 0):
+            raise ValueError("species matrix entries must be non-negative")
+        return matrix.copy()
+
+    def save_checkpoint(self, path):
+        """Write positions, velocities, parameters, step counter and RNG state to a .npz file"""
+        state = {name: getattr(self, name) for name in self.PARAMS + self.MATRICES}
+        if self.field is not None:
+            state.update({f"field_{key}": value for key, value in self.field.state().items()})
+        rng_state = json.dumps(self.rng.bit_generator.state, default=encode_array)
+        # Write to a temporary file first so a crash never leaves a half-written checkpoint
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f,
+                         n=self.n,
+                         size=self.size,
+                         steps=self.steps,
+                         pos=self.pos,
+                         vel=self.vel,
+                         species=self.species,
+                         rng_state=rng_state,
+                         **state)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load_checkpoint(cls, path):
+        """Rebuild an engine from save_checkpoint() output, continuing exactly where it stopped"""
+        with np.load(path) as data:
+            # Set the saved state directly instead of running __init__, which would draw
+            # and then discard a fresh random flock
+            boids = cls.__new__(cls)
+            boids.n = int(data["n"])
+            boids.size = data["size"].item()
+            for name in cls.PARAMS + cls.MATRICES:
+                setattr(boids, name, data[name].copy())
+            boids.species = data["species"].copy()
+            boids.field = None
+            if "field_obstacles" in data:
+                boids.field = DistanceField2D.from_state({key: data[f"field_{key}"] for key in DistanceField2D.STATE})
+            boids.steps = int(data["steps"])
+            boids.pos = data["pos"].copy()
+            boids.vel = data["vel"].copy()
+            rng_state = json.loads(str(data["rng_state"]), object_hook=decode_array)
+
+        # Seed 0 only avoids pulling OS entropy; the saved state replaces it
+        bit_generator = getattr(np.random, rng_state["bit_generator"])(0)
+        bit_generator.state = rng_state
+        boids.rng = np.random.Generator(bit_generator)
+        return boids
+
+    def limit_force(self, force, max_force):
+        """Limit each row of force to the matching max_force"""
+        magnitude = np.linalg.norm(force, axis=1)
+        scale = np.minimum(1.0, max_force / np.maximum(magnitude, 1e-12))
+        return force * scale[:, np.newaxis]
+
+    def steer(self, direction, idx):
+        """Steering force toward direction at max_speed for boids idx (zero where direction is zero)"""
+        norm = np.linalg.norm(direction, axis=1)
+        has_direction = norm > 0
+        desired = direction / np.where(has_direction, norm, 1)[:, np.newaxis]
+        desired *= self.max_speed[idx, np.newaxis]
+        force = self.limit_force(desired - self.vel[idx], self.max_force[idx])
+        return np.where(has_direction[:, np.newaxis], force, 0.0)
+
+    def boundary_force(self):
         """Steer away from boundaries"""
-        force = np.zeros(2)
         margin = 10  # Distance from edge to start steering
-        
-        # Left edge
-        if position[0] < margin:
-            force[0] = self.max_speed
-        # Right edge  
-        elif position[0] > self.size - margin:
-            force[0] = -self.max_speed
-            
-        # Bottom edge
-        if position[1] < margin:
-            force[1] = self.max_speed
-        # Top edge
-        elif position[1] > self.size - margin:
-            force[1] = -self.max_speed
-        
-        if np.linalg.norm(force) > 0:
-            force = force / np.linalg.norm(force) * self.max_speed
-            force = force - velocity
-            force = self.limit_force(force)
-        
+
+        # Push right/up near the low edges, left/down near the high edges
+        push = np.where(self.pos < margin, 1.0,
+                        np.where(self.pos > self.size - margin, -1.0, 0.0))
+        return self.steer(push, np.arange(self.n))
+
+    def field_force(self):
+        """Steer around obstacles and toward goals using the precomputed distance field"""
+        idx = np.arange(self.n)
+        distance, gradient, goal_gradient = self.field.sample(self.pos)
+
+        # The obstacle gradient points away from the nearest surface
+        near = distance < self.field.margin
+        avoid_force = self.steer(np.where(near[:, np.newaxis], gradient, 0.0), idx)
+
+        # Goal distance decreases along the negative gradient
+        seek_force = self.steer(-goal_gradient, idx)
+
+        return (avoid_force * self.obstacle_weight[:, np.newaxis] +
+                seek_force * self.attractor_weight[:, np.newaxis])
+
+    def resolve_obstacles(self):
+        """Push boids that ended up inside an obstacle back out and cancel their inward velocity"""
+        # Interpolated distances are approximate near the surface, so repeat a few times
+        for _ in range(4):
+            distance, gradient, _ = self.field.sample(self.pos)
+            inside = distance < 0
+            if not np.any(inside):
+                break
+
+            # The gradient vanishes at the centre of symmetric shapes, so back out along -vel there
+            norm = np.linalg.norm(gradient, axis=1, keepdims=True)
+            direction = np.where(norm > 1e-8, gradient, -self.vel)
+            direction /= np.maximum(np.linalg.norm(direction, axis=1, keepdims=True), 1e-8)
+
+            self.pos[inside] -= distance[inside, np.newaxis] * direction[inside]
+            self.pos = np.clip(self.pos, 0, self.size)
+
+            # Drop the velocity component heading into the obstacle so boids slide along its surface
+            normal = direction[inside]
+            inward = np.minimum(np.sum(self.vel[inside] * normal, axis=1), 0.0)
+            self.vel[inside] -= inward[:, np.newaxis] * normal
+
+    def flock_force(self):
+        """Weighted separation, alignment and cohesion for every boid"""
+        rows = max(1, self.CHUNK_PAIRS // max(self.n, 1))
+        force = np.zeros((self.n, 2))
+        for start in range(0, self.n, rows):
+            force[start:start + rows] = self.flock_chunk(np.arange(start, min(start + rows, self.n)))
         return force
-    
+
+    def flock_chunk(self, idx):
+        """flock_force() for one chunk of boids, comparing each against the whole flock"""
+        # Offsets from every boid to each boid in the chunk: shape (len(idx), n, 2)
+        diff = self.pos[idx, np.newaxis, :] - self.pos[np.newaxis, :, :]
+        distances = np.sqrt(np.sum(diff**2, axis=2))
+        others = distances > 0
+
+        # How much each neighbour counts, looked up by both species: shape (len(idx), n)
+        pair = (self.species[idx, np.newaxis], self.species[np.newaxis, :])
+        sep_w = self.separation_matrix[pair]
+        align_w = self.alignment_matrix[pair]
+        coh_w = self.cohesion_matrix[pair]
+
+        sep_neighbors = (distances < self.separation_radius[idx, np.newaxis]) & others
+        align_neighbors = (distances < self.alignment_radius[idx, np.newaxis]) & others
+        coh_neighbors = (distances < self.cohesion_radius[idx, np.newaxis]) & others
+
+        # Separation: move away from close neighbors, weighted by 1 / distance^2
+        sep_coef = np.where(sep_neighbors, sep_w / np.where(others, distances, 1)**2, 0.0)
+        sep_force = self.steer(np.einsum("ij,ijk->ik", sep_coef, diff), idx)
+
+        # Alignment: match neighbor velocities (only the direction of the sum matters)
+        align_coef = np.where(align_neighbors, align_w, 0.0)
+        align_force = self.steer(align_coef @ self.vel, idx)
+
+        # Cohesion: move toward neighbor center
+        coh_coef = np.where(coh_neighbors, coh_w, 0.0)
+        coh_total = coh_coef.sum(axis=1)
+        has_center = coh_total > 0
+        center_of_mass = (coh_coef @ self.pos) / np.where(has_center, coh_total, 1)[:, np.newaxis]
+        desired = np.where(has_center[:, np.newaxis], center_of_mass - self.pos[idx], 0.0)
+        coh_force = self.steer(desired, idx)
+
+        return (sep_force * self.separation_weight[idx, np.newaxis] +
+                align_force * self.alignment_weight[idx, np.newaxis] +
+                coh_force * self.cohesion_weight[idx, np.newaxis])
+
     def update(self):
         """Update all boids one step"""
-        accelerations = np.zeros_like(self.vel)
-        
-        for i in range(self.n):
-            # Calculate distances to all other boids
-            distances = np.sqrt(np.sum((self.pos - self.pos[i])**2, axis=1))
-            
-            # Find neighbors for each behavior
-            sep_neighbors = (distances < self.separation_radius) & (distances > 0)
-            align_neighbors = (distances < self.alignment_radius) & (distances > 0)
-            coh_neighbors = (distances < self.cohesion_radius) & (distances > 0)
-            
-            # Separation: move away from close neighbors
-            sep_force = np.zeros(2)
-            if np.any(sep_neighbors):
-                for j in range(self.n):
-                    if sep_neighbors[j]:
-                        diff = self.pos[i] - self.pos[j]
-                        distance = distances[j]
-                        if distance > 0:
-                            sep_force += diff / (distance ** 2)
-                
-                if np.linalg.norm(sep_force) > 0:
-                    sep_force = sep_force / np.linalg.norm(sep_force) * self.max_speed
-                    sep_force = sep_force - self.vel[i]
-                    sep_force = self.limit_force(sep_force)
-            
-            # Alignment: match neighbor velocities
-            align_force = np.zeros(2)
-            if np.any(align_neighbors):
-                avg_velocity = np.mean(self.vel[align_neighbors], axis=0)
-                if np.linalg.norm(avg_velocity) > 0:
-                    desired = avg_velocity / np.linalg.norm(avg_velocity) * self.max_speed
-                    align_force = desired - self.vel[i]
-                    align_force = self.limit_force(align_force)
-            
-            # Cohesion: move toward neighbor center
-            coh_force = np.zeros(2)
-            if np.any(coh_neighbors):
-                center_of_mass = np.mean(self.pos[coh_neighbors], axis=0)
-                desired = center_of_mass - self.pos[i]
-                if np.linalg.norm(desired) > 0:
-                    desired = desired / np.linalg.norm(desired) * self.max_speed
-                    coh_force = desired - self.vel[i]
-                    coh_force = self.limit_force(coh_force)
-            
-            # Add boundary steering force
-            boundary_force = self.boundary_force(self.pos[i], self.vel[i])
-            
-            # Apply weighted forces
-            total_force = (sep_force * self.separation_weight + 
-                          align_force * self.alignment_weight + 
-                          coh_force * self.cohesion_weight +
-                          boundary_force * 2.0)  # Strong boundary force
-            
-            accelerations[i] = total_force
-        
+        # Species only select matrix weights, so mixed flocks cost the same as homogeneous ones
+        accelerations = self.flock_force()
+
+        # Add boundary steering force
+        accelerations += self.boundary_force() * 2.0  # Strong boundary force
+
+        # Add obstacle and goal steering forces
+        if self.field is not None:
+            accelerations += self.field_force()
+
         # Update velocities
         self.vel += accelerations
-        
+
         # Limit speed
         speeds = np.linalg.norm(self.vel, axis=1)
         speed_limiters = np.minimum(speeds, self.max_speed) / np.maximum(speeds, 1e-8)
         self.vel *= speed_limiters[:, np.newaxis]
-        
+
         # Update positions
         self.pos += self.vel
-        
+        self.steps += 1
+
         # Keep boids within boundaries (no wrap-around)
         self.pos = np.clip(self.pos, 0, self.size)
 
+        # Keep boids out of obstacles
+        if self.field is not None:
+            self.resolve_obstacles()
@@ -1,9 +1,107 @@
+import json
+import os
+
 import numpy as np
 
 
+def encode_array(obj):
+    if isinstance(obj, np.ndarray):
+        return {"__ndarray__": obj.tolist(), "dtype": str(obj.dtype)}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def decode_array(obj):
+    if "__ndarray__" in obj:
+        return np.array(obj["__ndarray__"], dtype=obj["dtype"])
+    return obj
+
+
+class DistanceField3D:
+    # Precomputed signed-distance field for obstacles and goals, sampled with
+    # trilinear interpolation so per-step cost does not grow with obstacle count
+    CHANNELS = 7
+
+    # Settings and grids stored in checkpoints
+    STATE = ("size", "resolution", "margin", "obstacles", "goals")
+
+    def __init__(self, size=100, resolution=2.0, margin=5.0):
+        self.size = size
+        self.resolution = resolution
+        self.margin = margin
+        self.cells = int(np.ceil(size / resolution))
+
+        coords = np.arange(self.cells + 1) * resolution
+        self.points = np.stack(np.meshgrid(coords, coords, coords, indexing="ij"), axis=-1)
+
+        far = self.cells * resolution * np.sqrt(3)
+        self.obstacles = np.full(self.points.shape[:-1], far)
+        self.goals = np.full(self.points.shape[:-1], far)
+        self.table = np.zeros(self.points.shape[:-1] + (self.CHANNELS,))
+        self.build_table()
+
+    def build_table(self):
+        self.table[..., 0] = self.obstacles
+        self.table[..., 1:4] = np.stack(np.gradient(self.obstacles, self.resolution), axis=-1)
+        self.table[..., 4:7] = np.stack(np.gradient(self.goals, self.resolution), axis=-1)
+
+    def add_obstacle_distance(self, distance):
+        self.obstacles = np.minimum(self.obstacles, distance)
+        self.build_table()
+
+    def add_goal_distance(self, distance):
+        self.goals = np.minimum(self.goals, distance)
+        self.build_table()
+
+    def add_sphere(self, center, radius):
+        distance = np.linalg.norm(self.points - np.asarray(center, dtype=float), axis=-1) - radius
+        self.add_obstacle_distance(distance)
+
+    def add_goal(self, point):
+        self.add_goal_distance(np.linalg.norm(self.points - np.asarray(point, dtype=float), axis=-1))
+
+    def sample(self, positions):
+        u = np.clip(positions / self.resolution, 0, self.cells)
+        i0 = np.minimum(np.floor(u).astype(int), self.cells - 1)
+        t = u - i0
+
+        values = np.zeros((len(positions), self.CHANNELS))
+        for dx in (0, 1):
+            for dy in (0, 1):
+                for dz in (0, 1):
+                    weight = ((t[:, 0] if dx else 1 - t[:, 0]) *
+                              (t[:, 1] if dy else 1 - t[:, 1]) *
+                              (t[:, 2] if dz else 1 - t[:, 2]))
+                    values += weight[:, np.newaxis] * self.table[i0[:, 0] + dx, i0[:, 1] + dy, i0[:, 2] + dz]
+
+        return values[:, 0], values[:, 1:4], values[:, 4:7]
+
+    def state(self):
+        return {name: getattr(self, name) for name in self.STATE}
+
+    @classmethod
+    def from_state(cls, state):
+        size, resolution, margin = (np.asarray(state[name]).item() for name in ("size", "resolution", "margin"))
+        field = cls(size=size, resolution=resolution, margin=margin)
+        field.add_obstacle_distance(state["obstacles"])
+        field.add_goal_distance(state["goals"])
+        return field
+
+
 class Boids3D:
-    def __init__(self, 
-                 n=50, 
+    # Per-boid parameters stored in checkpoints alongside the arrays
+    PARAMS = ("max_speed", "max_force",
+              "separation_radius", "alignment_radius", "cohesion_radius",
+              "separation_weight", "alignment_weight", "cohesion_weight",
+              "obstacle_weight", "attractor_weight")
+
+    # Species-pair interaction matrices
+    MATRICES = ("separation_matrix", "alignment_matrix", "cohesion_matrix")
+
+    # Boid pairs handled per vectorized chunk, keeping update() memory flat as n grows
+    CHUNK_PAIRS = 2**18
+
+    def __init__(self,
+                 n=50,
                  size=100,
                  max_speed=2.0,
                  max_force=0.1,
@@ -12,115 +110,234 @@ class Boids3D:
                  cohesion_radius=10.0,
                  separation_weight=1.5,
                  alignment_weight=1.0,
-                 cohesion_weight=1.0):
+                 cohesion_weight=1.0,
+                 seed=None,
+                 species=None,
+                 separation_matrix=None,
+                 alignment_matrix=None,
+                 cohesion_matrix=None,
+                 field=None,
+                 obstacle_weight=2.0,
+                 attractor_weight=0.5):
         self.n = n
         self.size = size
-        self.max_speed = max_speed
-        self.max_force = max_force
-        self.separation_radius = separation_radius
-        self.alignment_radius = alignment_radius
-        self.cohesion_radius = cohesion_radius
-        self.separation_weight = separation_weight
-        self.alignment_weight = alignment_weight
-        self.cohesion_weight = cohesion_weight
-        
+        # Scalars are shared by the whole flock, arrays give one value per boid
+        self.max_speed = self.per_boid(max_speed)
+        self.max_force = self.per_boid(max_force)
+        self.separation_radius = self.per_boid(separation_radius)
+        self.alignment_radius = self.per_boid(alignment_radius)
+        self.cohesion_radius = self.per_boid(cohesion_radius)
+        self.separation_weight = self.per_boid(separation_weight)
+        self.alignment_weight = self.per_boid(alignment_weight)
+        self.cohesion_weight = self.per_boid(cohesion_weight)
+        self.obstacle_weight = self.per_boid(obstacle_weight)
+        self.attractor_weight = self.per_boid(attractor_weight)
+        if field is not None and field.size != size:
+            raise ValueError(f"field size {field.size} does not match world size {size}")
+        self.field = field
+
+        # matrix[a, b] scales how strongly species a reacts to neighbours of species b
+        if species is None:
+            species = np.zeros(n, dtype=int)
+        self.species = np.asarray(species, dtype=int)
+        if self.species.shape != (n,):
+            raise ValueError(f"species must have shape ({n},), got {self.species.shape}")
+        if n > 0 and self.species.min() < 0:
+            raise ValueError("species tags must be non-negative")
+        n_species = int(self.species.max()) + 1 if n > 0 else 1
+        self.separation_matrix = self.species_matrix(separation_matrix, n_species)
+        self.alignment_matrix = self.species_matrix(alignment_matrix, n_species)
+        self.cohesion_matrix = self.species_matrix(cohesion_matrix, n_species)
+
+        self.rng = np.random.default_rng(seed)
+        self.steps = 0
+
         # Random positions and velocities in 3D
-        self.pos = np.random.random((n, 3)) * size
-        self.vel = (np.random.random((n, 3)) - 0.5) * max_speed
-        
+        self.pos = self.rng.random((n, 3)) * size
+        self.vel = (self.rng.random((n, 3)) - 0.5) * self.max_speed[:, np.newaxis]
+
         # Normalize initial velocities
         speeds = np.linalg.norm(self.vel, axis=1)
         speeds = np.where(speeds == 0, 1, speeds)
-        self.vel = self.vel / speeds[:, np.newaxis] * max_speed
-    
-    def limit_force(self, force):
-        magnitude = np.linalg.norm(force)
-        if magnitude > self.max_force:
-            return force / magnitude * self.max_force
-        return force
-    
-    def boundary_force(self, position, velocity):
-        force = np.zeros(3)
+        self.vel = self.vel / speeds[:, np.newaxis] * self.max_speed[:, np.newaxis]
+
+        if self.field is not None:
+            self.resolve_obstacles()
+
+    def per_boid(self, value):
+        value = np.asarray(value, dtype=float)
+        if value.ndim == 0:
+            return np.full(self.n, float(value))
+        if value.shape != (self.n,):
+            raise ValueError(f"per-boid parameter must have shape ({self.n},), got {value.shape}")
+        return value.copy()
+
+    def species_matrix(self, matrix, n_species):
+        if matrix is None:
+            return np.ones((n_species, n_species))
+        matrix = np.asarray(matrix, dtype=float)
+        if matrix.ndim != 2 or matrix.shape[0] != matrix.shape[1] or matrix.shape[0] < n_species:
+            raise ValueError(f"species matrix must be square and cover {n_species} species, "
+                             f"got shape {matrix.shape}")
+        # Weights feed weighted means, which break down when mixed signs cancel out
+        if np.any(matrix < 0):
+            raise ValueError("species matrix entries must be non-negative")
+        return matrix.copy()
+
+    def save_checkpoint(self, path):
+        state = {name: getattr(self, name) for name in self.PARAMS + self.MATRICES}
+        if self.field is not None:
+            state.update({f"field_{key}": value for key, value in self.field.state().items()})
+        rng_state = json.dumps(self.rng.bit_generator.state, default=encode_array)
+        # Write to a temporary file first so a crash never leaves a half-written checkpoint
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f,
+                         n=self.n,
+                         size=self.size,
+                         steps=self.steps,
+                         pos=self.pos,
+                         vel=self.vel,
+                         species=self.species,
+                         rng_state=rng_state,
+                         **state)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load_checkpoint(cls, path):
+        with np.load(path) as data:
+            # Skip __init__ so no throwaway random flock is drawn
+            boids = cls.__new__(cls)
+            boids.n = int(data["n"])
+            boids.size = data["size"].item()
+            for name in cls.PARAMS + cls.MATRICES:
+                setattr(boids, name, data[name].copy())
+            boids.species = data["species"].copy()
+            boids.field = None
+            if "field_obstacles" in data:
+                boids.field = DistanceField3D.from_state({key: data[f"field_{key}"] for key in DistanceField3D.STATE})
+            boids.steps = int(data["steps"])
+            boids.pos = data["pos"].copy()
+            boids.vel = data["vel"].copy()
+            rng_state = json.loads(str(data["rng_state"]), object_hook=decode_array)
+
+        bit_generator = getattr(np.random, rng_state["bit_generator"])(0)
+        bit_generator.state = rng_state
+        boids.rng = np.random.Generator(bit_generator)
+        return boids
+
+    def limit_force(self, force, max_force):
+        magnitude = np.linalg.norm(force, axis=1)
+        scale = np.minimum(1.0, max_force / np.maximum(magnitude, 1e-12))
+        return force * scale[:, np.newaxis]
+
+    def steer(self, direction, idx):
+        norm = np.linalg.norm(direction, axis=1)
+        has_direction = norm > 0
+        desired = direction / np.where(has_direction, norm, 1)[:, np.newaxis]
+        desired *= self.max_speed[idx, np.newaxis]
+        force = self.limit_force(desired - self.vel[idx], self.max_force[idx])
+        return np.where(has_direction[:, np.newaxis], force, 0.0)
+
+    def boundary_force(self):
         margin = 10
-        
-        if position[0] < margin:
-            force[0] = self.max_speed
-        elif position[0] > self.size - margin:
-            force[0] = -self.max_speed
-            
-        if position[1] < margin:
-            force[1] = self.max_speed
-        elif position[1] > self.size - margin:
-            force[1] = -self.max_speed
-            
-        if position[2] < margin:
-            force[2] = self.max_speed
-        elif position[2] > self.size - margin:
-            force[2] = -self.max_speed
-        
-        if np.linalg.norm(force) > 0:
-            force = force / np.linalg.norm(force) * self.max_speed
-            force = force - velocity
-            force = self.limit_force(force)
-        
+
+        push = np.where(self.pos < margin, 1.0,
+                        np.where(self.pos > self.size - margin, -1.0, 0.0))
+        return self.steer(push, np.arange(self.n))
+
+    def field_force(self):
+        idx = np.arange(self.n)
+        distance, gradient, goal_gradient = self.field.sample(self.pos)
+
+        near = distance < self.field.margin
+        avoid_force = self.steer(np.where(near[:, np.newaxis], gradient, 0.0), idx)
+        seek_force = self.steer(-goal_gradient, idx)
+
+        return (avoid_force * self.obstacle_weight[:, np.newaxis] +
+                seek_force * self.attractor_weight[:, np.newaxis])
+
+    def resolve_obstacles(self):
+        # Interpolated distances are approximate near the surface, so repeat a few times
+        for _ in range(4):
+            distance, gradient, _ = self.field.sample(self.pos)
+            inside = distance < 0
+            if not np.any(inside):
+                break
+
+            # The gradient vanishes at the centre of spheres, so back out along -vel there
+            norm = np.linalg.norm(gradient, axis=1, keepdims=True)
+            direction = np.where(norm > 1e-8, gradient, -self.vel)
+            direction /= np.maximum(np.linalg.norm(direction, axis=1, keepdims=True), 1e-8)
+
+            self.pos[inside] -= distance[inside, np.newaxis] * direction[inside]
+            self.pos = np.clip(self.pos, 0, self.size)
+
+            # Slide along the surface instead of hitting it again next step
+            normal = direction[inside]
+            inward = np.minimum(np.sum(self.vel[inside] * normal, axis=1), 0.0)
+            self.vel[inside] -= inward[:, np.newaxis] * normal
+
+    def flock_force(self):
+        rows = max(1, self.CHUNK_PAIRS // max(self.n, 1))
+        force = np.zeros((self.n, 3))
+        for start in range(0, self.n, rows):
+            force[start:start + rows] = self.flock_chunk(np.arange(start, min(start + rows, self.n)))
         return force
-    
+
+    def flock_chunk(self, idx):
+        # Offsets from every boid to each boid in the chunk: shape (len(idx), n, 3)
+        diff = self.pos[idx, np.newaxis, :] - self.pos[np.newaxis, :, :]
+        distances = np.sqrt(np.sum(diff**2, axis=2))
+        others = distances > 0
+
+        pair = (self.species[idx, np.newaxis], self.species[np.newaxis, :])
+        sep_w = self.separation_matrix[pair]
+        align_w = self.alignment_matrix[pair]
+        coh_w = self.cohesion_matrix[pair]
+
+        sep_neighbors = (distances < self.separation_radius[idx, np.newaxis]) & others
+        align_neighbors = (distances < self.alignment_radius[idx, np.newaxis]) & others
+        coh_neighbors = (distances < self.cohesion_radius[idx, np.newaxis]) & others
+
+        # Separation
+        sep_coef = np.where(sep_neighbors, sep_w / np.where(others, distances, 1)**2, 0.0)
+        sep_force = self.steer(np.einsum("ij,ijk->ik", sep_coef, diff), idx)
+
+        # Alignment
+        align_coef = np.where(align_neighbors, align_w, 0.0)
+        align_force = self.steer(align_coef @ self.vel, idx)
+
+        # Cohesion
+        coh_coef = np.where(coh_neighbors, coh_w, 0.0)
+        coh_total = coh_coef.sum(axis=1)
+        has_center = coh_total > 0
+        center_of_mass = (coh_coef @ self.pos) / np.where(has_center, coh_total, 1)[:, np.newaxis]
+        desired = np.where(has_center[:, np.newaxis], center_of_mass - self.pos[idx], 0.0)
+        coh_force = self.steer(desired, idx)
+
+        return (sep_force * self.separation_weight[idx, np.newaxis] +
+                align_force * self.alignment_weight[idx, np.newaxis] +
+                coh_force * self.cohesion_weight[idx, np.newaxis])
+
     def update(self):
-        accelerations = np.zeros_like(self.vel)
-        
-        for i in range(self.n):
-            distances = np.sqrt(np.sum((self.pos - self.pos[i])**2, axis=1))
-            
-            sep_neighbors = (distances < self.separation_radius) & (distances > 0)
-            align_neighbors = (distances < self.alignment_radius) & (distances > 0)
-            coh_neighbors = (distances < self.cohesion_radius) & (distances > 0)
-            
-            # Separation
-            sep_force = np.zeros(3)
-            if np.any(sep_neighbors):
-                for j in range(self.n):
-                    if sep_neighbors[j]:
-                        diff = self.pos[i] - self.pos[j]
-                        distance = distances[j]
-                        if distance > 0:
-                            sep_force += diff / (distance ** 2)
-                
-                if np.linalg.norm(sep_force) > 0:
-                    sep_force = sep_force / np.linalg.norm(sep_force) * self.max_speed
-                    sep_force = sep_force - self.vel[i]
-                    sep_force = self.limit_force(sep_force)
-            
-            # Alignment
-            align_force = np.zeros(3)
-            if np.any(align_neighbors):
-                avg_velocity = np.mean(self.vel[align_neighbors], axis=0)
-                if np.linalg.norm(avg_velocity) > 0:
-                    desired = avg_velocity / np.linalg.norm(avg_velocity) * self.max_speed
-                    align_force = desired - self.vel[i]
-                    align_force = self.limit_force(align_force)
-            
-            # Cohesion
-            coh_force = np.zeros(3)
-            if np.any(coh_neighbors):
-                center_of_mass = np.mean(self.pos[coh_neighbors], axis=0)
-                desired = center_of_mass - self.pos[i]
-                if np.linalg.norm(desired) > 0:
-                    desired = desired / np.linalg.norm(desired) * self.max_speed
-                    coh_force = desired - self.vel[i]
-                    coh_force = self.limit_force(coh_force)
-            
-            boundary_force = self.boundary_force(self.pos[i], self.vel[i])
-            
-            total_force = (sep_force * self.separation_weight + 
-                          align_force * self.alignment_weight + 
-                          coh_force * self.cohesion_weight +
-                          boundary_force * 2.0)
-            
-            accelerations[i] = total_force
-        
+        accelerations = self.flock_force()
+
+        accelerations += self.boundary_force() * 2.0
+        if self.field is not None:
+            accelerations += self.field_force()
+
         self.vel += accelerations
         speeds = np.linalg.norm(self.vel, axis=1)
         speed_limiters = np.minimum(speeds, self.max_speed) / np.maximum(speeds, 1e-8)
         self.vel *= speed_limiters[:, np.newaxis]
         self.pos += self.vel
-        self.pos = np.clip(self.pos, 0, self.size)
\ No newline at end of file
+        self.steps += 1
+        self.pos = np.clip(self.pos, 0, self.size)
+        if self.field is not None:
+            self.resolve_obstacles()